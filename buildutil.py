@@ -0,0 +1,400 @@
+"""
+Infrastructure for the APiCS CLDF build, i.e. functionality which is not about the data itself but
+about how `cldfbench makecldf` runs.
+"""
+import os
+import json
+import pickle
+import typing
+import sqlite3
+import pathlib
+import tempfile
+import itertools
+import threading
+import dataclasses
+import collections
+import multiprocessing
+import concurrent.futures
+import collections.abc
+
+ENV_PREFIX = 'APICS_'
+
+
+def _convert(type_, value: str):
+    if typing.get_origin(type_) is typing.Union:  # Optional[...]
+        type_ = [t for t in typing.get_args(type_) if t is not type(None)][0]
+    if type_ is bool:
+        return value.strip().lower() in {'1', 'true', 'yes', 'on'}
+    if typing.get_origin(type_) is tuple:
+        return tuple(v.strip() for v in value.split(',') if v.strip())
+    return type_(value)
+
+
+@dataclasses.dataclass(frozen=True)
+class BuildOptions:
+    """
+    Options to tweak the build.
+
+    Since `cldfbench makecldf` does not allow datasets to register command line arguments, options
+    are read from environment variables, named like the fields, upper-cased and prefixed with
+    `APICS_`, e.g. `APICS_ZIP_MEDIA=1`.
+    """
+    # Package media files into one store-only ZIP archive per directory.
+    zip_media: bool = False
+    # Directory to write Arrow IPC exports of the main tables to.
+    columnar_export: typing.Optional[pathlib.Path] = None
+    # Directory to write precomputed per-parameter map layers to.
+    map_layers: typing.Optional[pathlib.Path] = None
+    # Comma-separated IDs of languages and/or parameters to restrict the build to.
+    languages: tuple[str, ...] = ()
+    parameters: tuple[str, ...] = ()
+    # Number of threads to run independent build stages on.
+    workers: int = 1
+    # Directory of a media cache shared across checkouts, and its size limit in MB.
+    media_cache: typing.Optional[pathlib.Path] = None
+    media_cache_mb: int = 2048
+    # Losslessly recompress survey maps and link them from the survey pages via thumbnails.
+    optimize_images: bool = False
+    # Split chapters into fragments per section, which are loaded on demand by the chapter page.
+    sectioned_chapters: bool = False
+    # Link the references of chapters to one bibliography, rather than embedding them.
+    shared_references: bool = False
+    # Maximal number of rows of large tables to hold in memory before spilling them to disk.
+    spill_rows: int = 0
+
+    @classmethod
+    def from_env(cls, environ: typing.Optional[typing.Mapping[str, str]] = None) -> 'BuildOptions':
+        environ = os.environ if environ is None else environ
+        kw = {}
+        for field in dataclasses.fields(cls):
+            value = environ.get(ENV_PREFIX + field.name.upper())
+            if value is not None:
+                kw[field.name] = _convert(field.type, value)
+        return cls(**kw)
+
+    def subset(self) -> 'Subset':
+        return Subset(set(self.languages), set(self.parameters))
+
+
+@dataclasses.dataclass
+class Subset:
+    """
+    Selection of languages and parameters to restrict the build to, e.g. for quick iterations
+    during development. An empty selection means "all".
+    """
+    languages: set[str] = dataclasses.field(default_factory=set)
+    parameters: set[str] = dataclasses.field(default_factory=set)
+
+    def __bool__(self):
+        return bool(self.languages or self.parameters)
+
+    def language(self, lid: str) -> bool:
+        return (not self.languages) or lid in self.languages
+
+    def parameter(self, pid: str) -> bool:
+        return (not self.parameters) or pid in self.parameters
+
+    def value(self, lid: str, pid: str) -> bool:
+        return self.language(lid) and self.parameter(pid)
+
+
+# Foreign keys to check, grouped by referencing table: (column, referenced table)
+FOREIGN_KEYS = {
+    'ValueTable': [
+        ('Language_ID', 'LanguageTable'),
+        ('Parameter_ID', 'ParameterTable'),
+        ('Code_ID', 'CodeTable'),
+        ('Example_ID', 'ExampleTable'),
+        ('Source', 'Source'),
+    ],
+    'CodeTable': [('Parameter_ID', 'ParameterTable')],
+    'LanguageTable': [('Default_Lect_ID', 'LanguageTable'), ('Source', 'Source')],
+    'ExampleTable': [
+        ('Language_ID', 'LanguageTable'),
+        ('Audio', 'MediaTable'),
+        ('Source', 'Source'),
+    ],
+    'ContributionTable': [
+        ('Contributor_IDs', 'contributors.csv'),
+        ('Language_IDs', 'LanguageTable'),
+        ('Parameter_ID', 'ParameterTable'),
+    ],
+    'MediaTable': [
+        ('Contribution_ID', 'ContributionTable'),
+        ('Language_IDs', 'LanguageTable'),
+    ],
+    'featurestatistics.csv': [('Parameter_ID', 'ParameterTable'), ('Code_ID', 'CodeTable')],
+}
+
+
+def check_integrity(objects, source_ids: typing.Iterable[str]) -> list[str]:
+    """
+    Check uniqueness of IDs and referential integrity of the CLDF objects collected during the
+    build - using set operations on the IDs, thus much faster than a full validation of the
+    written dataset.
+
+    :return: List of error messages.
+    """
+    errors = []
+    ids = {'Source': set(source_ids)}
+    for table in set(ref for fks in FOREIGN_KEYS.values() for _, ref in fks) - {'Source'}:
+        ids[table] = {row['ID'] for row in objects[table]}
+        if len(ids[table]) != len(objects[table]):
+            errors.append(f'{table}: {len(objects[table]) - len(ids[table])} duplicate IDs')
+
+    for table, fks in FOREIGN_KEYS.items():
+        refs = collections.defaultdict(set)
+        for row in objects[table]:
+            for col, _ in fks:
+                if row.get(col):
+                    refs[col].update(row[col] if isinstance(row[col], list) else [row[col]])
+        for col, ref in fks:
+            if ref == 'Source':  # Strip the citation context, e.g. "key[12-13]".
+                refs[col] = {r.split('[')[0] for r in refs[col]}
+            missing = refs[col] - ids[ref]
+            if missing:
+                errors.append('{}.{}: {} invalid references to {}, e.g. {}'.format(
+                    table, col, len(missing), ref, ', '.join(sorted(missing)[:3])))
+    return errors
+
+
+def check_counts(cldf, objects, expected: dict[str, int]) -> list[str]:
+    """
+    Compare the number of rows per table with the expected counts, keyed by table URL.
+
+    :return: List of messages about deviations.
+    """
+    res = []
+    for key, rows in objects.items():
+        url = str(cldf[key].url)
+        if url in expected and expected[url] != len(rows):
+            res.append(f'{url}: {len(rows)} rows, expected {expected[url]}')
+    return res
+
+
+@dataclasses.dataclass
+class Stage:
+    """
+    A stage of the build, declaring the resources it requires as `inputs` and the resources it
+    provides as `outputs`. `func` is called with a `dict` mapping names of completed stages to
+    their results.
+    """
+    name: str
+    func: typing.Callable[[dict[str, typing.Any]], typing.Any]
+    inputs: tuple[str, ...] = ()
+    outputs: tuple[str, ...] = ()
+
+
+def run_stages(stages: list[Stage], workers: int = 1) -> dict[str, typing.Any]:
+    """
+    Run each stage as soon as all its inputs are available, on a pool of `workers` threads.
+
+    Stages which are ready at the same time are submitted in the order in which they are listed,
+    thus with `workers=1` stages run sequentially in this order.
+
+    :return: `dict` mapping stage names to results.
+    """
+    providers = {o: stage.name for stage in stages for o in stage.outputs}
+    for stage in stages:
+        for i in stage.inputs:
+            if i not in providers:
+                raise ValueError(f'No stage provides input {i} of stage {stage.name}')
+
+    results, available, pending, running = {}, set(), list(stages), {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for stage in [s for s in pending if set(s.inputs) <= available]:
+                pending.remove(stage)
+                running[pool.submit(stage.func, results)] = stage
+            if not running:
+                raise ValueError('Cyclic dependencies between stages {}'.format(
+                    ', '.join(s.name for s in pending)))
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage.name] = future.result()
+                available.update(stage.outputs)
+    return results
+
+
+class MetadataEncoder:
+    """
+    Encode `dict`s as JSON with sorted top-level keys - the canonical form of metadata in our CLDF
+    data - interning the results, i.e. identical payloads share the same `str` object. E.g. the
+    ~19,000 valuesets have only ~600 distinct metadata payloads.
+    """
+    def __init__(self):
+        self._strings = {}
+
+    def __call__(self, obj: dict) -> str:
+        # We intern the serialized JSON, since e.g. `1`, `1.0` and `True` compare equal in Python.
+        res = json.dumps(collections.OrderedDict(sorted(obj.items(), key=lambda i: i[0])))
+        return self._strings.setdefault(res, res)  # `dict.setdefault` is atomic, i.e. thread-safe.
+
+
+def _write_table(table, rows, zipped):
+    return table.write(rows, _zipped=zipped)
+
+
+def write_tables(cldf, tables: dict[str, list], zipped=None, workers: int = 1):
+    """
+    Write the data files of `tables` concurrently, like `pycldf.Dataset.write` does sequentially.
+
+    Serializing rows is CPU-bound, so tables are written in separate processes, largest first.
+    """
+    zipped = zipped or set()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {
+            key: pool.submit(_write_table, cldf[key], rows, key in zipped)
+            for key, rows in sorted(tables.items(), key=lambda i: -len(i[1]))}
+    for key, future in futures.items():
+        cldf[key].common_props['dc:extent'] = future.result()
+
+
+class SpillStore:
+    """
+    Temporary on-disk storage for large tables, to bound the memory used by the build.
+
+    Lists created with `SpillStore.list` move their rows to SQLite databases once all these lists
+    together hold more than `max_rows` rows in memory.
+    """
+    def __init__(self, max_rows: int):
+        self.max_rows = max_rows
+        self.in_memory = 0
+        self.lock = threading.Lock()
+        self._tmp = tempfile.TemporaryDirectory(prefix='apics-')
+        self._count = itertools.count()
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            pathlib.Path(self._tmp.name) / f'{next(self._count)}.sqlite', check_same_thread=False)
+        # The databases are only temporary, so we don't need durability.
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        return db
+
+    def list(self) -> 'SpillList':
+        return SpillList(self)
+
+    def mapping(self, items: typing.Iterable[tuple[str, typing.Any]]) -> 'SpillMapping':
+        return SpillMapping(self, items)
+
+    def acquire(self, n: int) -> bool:
+        """:return: Flag signaling whether the memory budget is exceeded."""
+        with self.lock:
+            self.in_memory += n
+            return self.in_memory > self.max_rows
+
+    def release(self, n: int):
+        with self.lock:
+            self.in_memory -= n
+
+
+class SpillList:
+    """
+    A list of rows - supporting the subset of the `list` API used for CLDF objects - whose rows
+    are moved to disk when the memory budget of the store is exceeded.
+
+    Spilled rows are stored pickled, in order, and streamed back when iterating.
+    """
+    def __init__(self, store: SpillStore):
+        self.store = store
+        self.rows = []
+        self.db = None
+        self.spilled = 0
+
+    def __len__(self):
+        return self.spilled + len(self.rows)
+
+    def __iter__(self):
+        if self.db is not None:
+            for (row,) in self.db.execute('SELECT row FROM rows ORDER BY rowid'):
+                yield pickle.loads(row)
+        yield from self.rows
+
+    def append(self, row):
+        self.rows.append(row)
+        if self.store.acquire(1):
+            self.spill()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def spill(self):
+        if self.db is None:
+            self.db = self.store.connect()
+            self.db.execute('CREATE TABLE rows (row BLOB)')
+        self.db.executemany(
+            'INSERT INTO rows (row) VALUES (?)',
+            ((pickle.dumps(row, protocol=pickle.HIGHEST_PROTOCOL),) for row in self.rows))
+        self.db.commit()
+        self.store.release(len(self.rows))
+        self.spilled += len(self.rows)
+        self.rows = []
+
+    def sort(self, key):
+        """
+        Stable sort by `key` - which must return a `str` or number or a tuple of these. Spilled
+        rows are sorted by SQLite, thus on disk.
+        """
+        if self.db is None:
+            self.rows.sort(key=key)
+            return
+        self.spill()
+
+        def keyed():
+            for (row,) in self.db.execute('SELECT row FROM rows ORDER BY rowid'):
+                k = key(pickle.loads(row))
+                yield (*(k if isinstance(k, tuple) else (k,)), row)
+
+        rows = keyed()
+        first = next(rows, None)
+        if first is None:
+            return
+        cols = ', '.join(f'k{i}' for i in range(len(first) - 1))
+        self.db.execute(f'CREATE TABLE keyed ({cols}, row BLOB)')
+        self.db.executemany(
+            'INSERT INTO keyed VALUES ({})'.format(', '.join('?' * len(first))),
+            itertools.chain([first], rows))
+        # Ties are resolved by rowid, i.e. by insertion order, so sorting is stable.
+        self.db.execute(f'CREATE TABLE sorted AS SELECT row FROM keyed ORDER BY {cols}, rowid')
+        self.db.execute('DROP TABLE rows')
+        self.db.execute('DROP TABLE keyed')
+        self.db.execute('ALTER TABLE sorted RENAME TO rows')
+        self.db.commit()
+
+    def sorted(self, key) -> 'SpillList':
+        """Sorted copy of the list, like `sorted(rows, key=key)`."""
+        res = SpillList(self.store)
+        res.extend(self)
+        res.sort(key)
+        return res
+
+
+class SpillMapping(collections.abc.Mapping):
+    """
+    A read-only mapping of rows, stored on disk, e.g. to look up rows of a raw table by pk.
+    """
+    def __init__(self, store: SpillStore, items: typing.Iterable[tuple[str, typing.Any]]):
+        self.db = store.connect()
+        self.db.execute('CREATE TABLE items (key TEXT PRIMARY KEY, row BLOB)')
+        self.db.executemany(
+            'INSERT INTO items VALUES (?, ?)',
+            ((k, pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in items))
+        self.db.commit()
+
+    def __getitem__(self, key):
+        res = self.db.execute('SELECT row FROM items WHERE key = ?', (key,)).fetchone()
+        if res is None:
+            raise KeyError(key)
+        return pickle.loads(res[0])
+
+    def __iter__(self):
+        for (key,) in self.db.execute('SELECT key FROM items ORDER BY rowid'):
+            yield key
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM items').fetchone()[0]
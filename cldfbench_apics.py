@@ -1,3 +1,12 @@
+"""
+The APiCS CLDF dataset.
+
+This module is loaded via the `cldfbench.dataset` entry point, e.g. for dataset discovery or
+`cldfbench readme`, so importing it should be cheap: Modules only needed to build the dataset are
+imported where they are used.
+"""
+from __future__ import annotations
+
 import json
 import typing
 import pathlib
@@ -5,16 +14,19 @@ import operator
 import functools
 import itertools
 import collections
-import urllib.request
 
 from clldutils.path import md5
-from clldutils.html import HTML
 from clldutils.jsonlib import load
-from cldfbench import Dataset as BaseDataset, CLDFSpec
+from cldfbench import Dataset as BaseDataset, CLDFSpec, CLDFWriter
 from pycldf.sources import Source, Reference
+from csvw import dsv
 from csvw.metadata import URITemplate
 
-from mediautil import contribution_media, MediaTable, Contributors, LanguageMetadata, TableOfContents, LanguageContributions
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from mediautil import (
+        MediaTable, MediaCache, Contributors, LanguageMetadata, TableOfContents, ReferenceStore)
+    from buildutil import BuildOptions, Subset, MetadataEncoder, SpillStore
+    from exportutil import MapLayers, FeatureStatistics
 
 ObjectsType = dict[str, list[dict[str, typing.Any]]]
 PkMapType = dict[str, dict[str, str]]
@@ -50,16 +62,43 @@ CONFIDENCE_FIX = {
 }
 
 
+class Writer(CLDFWriter):
+    def write(self, zipped=None, **kw):
+        from buildutil import write_tables
+        from releaseutil import write_manifest
+
+        media = kw.get('MediaTable')
+        workers = self.dataset.options.workers if self.dataset else 1
+        if workers > 1:
+            # Write the data files concurrently, leaving sources and metadata to pycldf. Tables
+            # spilled to disk are streamed from this process.
+            write_tables(
+                self.cldf,
+                {k: v for k, v in kw.items() if isinstance(v, list)},
+                zipped=zipped,
+                workers=workers)
+            kw = {k: v for k, v in kw.items() if not isinstance(v, list)}
+        super().write(zipped=zipped, **kw)
+        # Now that all files are written, we can compute the manifest.
+        write_manifest(self.cldf_spec.dir, media)
+
+
 class Dataset(BaseDataset):
     dir = pathlib.Path(__file__).parent
     id = "apics"
 
     def cldf_specs(self):  # A dataset must declare all CLDF sets it creates.
-        return CLDFSpec(module='StructureDataset', dir=self.cldf_dir)
+        return CLDFSpec(module='StructureDataset', dir=self.cldf_dir, writer_cls=Writer)
 
     def cmd_download(self, args):
         pass
 
+    @functools.cached_property
+    def options(self) -> BuildOptions:
+        from buildutil import BuildOptions
+
+        return BuildOptions.from_env()
+
     @functools.cached_property
     def cdstar(self):
         res = {}
@@ -74,6 +113,13 @@ class Dataset(BaseDataset):
                     bs['checksum'])
         return res
 
+    @functools.cached_property
+    def media_cache(self) -> typing.Optional[MediaCache]:
+        from mediautil import MediaCache
+
+        if self.options.media_cache:
+            return MediaCache(self.options.media_cache, self.options.media_cache_mb * 1024 ** 2)
+
     def get_file(self, obj, suffix=None):
         bsid = obj['jsondata']['original']
         url, checksum = self.cdstar[bsid]
@@ -81,7 +127,14 @@ class Dataset(BaseDataset):
         if suffix:
             assert p.suffix == suffix
         if not p.exists():
-            urllib.request.urlretrieve(url, str(p))
+            p.parent.mkdir(exist_ok=True)
+            if not (self.media_cache and self.media_cache.get(checksum, p)):
+                import urllib.request
+
+                urllib.request.urlretrieve(url, str(p))
+                assert md5(p) == checksum
+                if self.media_cache:
+                    self.media_cache.put(p, checksum)
         assert md5(p) == checksum
         return p, checksum
 
@@ -116,50 +169,252 @@ APiCS covers 76 pidgin and creole languages from around the world.
 """
 
     def cmd_makecldf(self, args):
+        from mediautil import MediaTable, TableOfContents, ReferenceStore
+        from buildutil import (
+            Stage, MetadataEncoder, SpillStore, run_stages, check_integrity, check_counts)
+        from exportutil import write_columnar, write_citations, MapLayers, FeatureStatistics
+
         media = MediaTable.from_cdstar(
-            args.writer.objects, self.cldf_dir, load(self.raw_dir / 'cdstar.json'))
+            args.writer.objects,
+            self.cldf_dir,
+            load(self.raw_dir / 'cdstar.json'),
+            zipped=self.options.zip_media)
         self.create_schema(args.writer.cldf, media)
         for subdirs in ['Atlas', 'Survey', 'Examples']:
             d = self.cldf_dir / subdirs
             d.mkdir(exist_ok=True)
 
+        subset = self.options.subset()
         pk2id: PkMapType = collections.defaultdict(dict)
-        args.writer.cldf.add_sources(*list(self.itersources(pk2id)))
+        index = TableOfContents()
+        layers = MapLayers()
+        encoder = MetadataEncoder()
+        references = ReferenceStore() if self.options.shared_references else None
+        # Stages which may run concurrently collect their objects separately. These are merged
+        # into `args.writer.objects` in the order given here, thus independent of timing.
+        objects: dict[str, ObjectsType] = {
+            name: collections.defaultdict(list)
+            for name in ['languages', 'features', 'examples', 'values']}
+        spill = SpillStore(self.options.spill_rows) if self.options.spill_rows else None
+        if spill:  # The large tables are moved to disk when exceeding the memory budget.
+            objects['examples']['ExampleTable'] = spill.list()
+            objects['values']['ValueTable'] = spill.list()
+
+        try:
+            results = run_stages(
+                [
+                    Stage(
+                        'sources',
+                        lambda _: self._read_sources(pk2id),
+                        outputs=('pk2id.source',)),
+                    Stage(
+                        'contributors',
+                        lambda _: self._read_contributors(pk2id),
+                        outputs=('pk2id.contributor', 'contributors')),
+                    Stage(
+                        'ids',
+                        lambda _: self._read_ids(pk2id, subset),
+                        outputs=('pk2id.language', 'pk2id.parameter', 'subset')),
+                    Stage(
+                        'images',
+                        lambda _: self._optimize_images(subset),
+                        inputs=('subset',),
+                        outputs=('images',)),
+                    Stage(
+                        'languages',
+                        lambda res: self._add_languages(
+                            objects['languages'],
+                            pk2id,
+                            media.bind(objects['languages']),
+                            res['contributors'],
+                            index,
+                            layers,
+                            subset,
+                            res['images'],
+                            references),
+                        inputs=('pk2id.source', 'contributors', 'pk2id.language', 'subset', 'images'),
+                        outputs=('LanguageTable', 'index.survey')),
+                    Stage(
+                        'features',
+                        lambda res: self._add_features(
+                            objects['features'],
+                            media.bind(objects['features']),
+                            res['contributors'],
+                            index,
+                            encoder,
+                            subset,
+                            references),
+                        inputs=('contributors', 'pk2id.parameter'),
+                        outputs=('ParameterTable', 'index.atlas')),
+                    Stage(
+                        'index',
+                        # Pages in ZIP archives can't be browsed, thus there's no index to write.
+                        lambda _: None if media.zipped else index.write(self.cldf_dir / 'index.html'),
+                        inputs=('index.survey', 'index.atlas')),
+                    Stage(
+                        'examples',
+                        lambda _: self._add_examples(
+                            objects['examples'], pk2id, media.bind(objects['examples']), subset, spill),
+                        inputs=('pk2id.source', 'pk2id.language', 'pk2id.parameter', 'subset'),
+                        outputs=('ExampleTable', 'example_by_value')),
+                    Stage(
+                        'values',
+                        lambda res: self._add_values(
+                            objects['values'],
+                            pk2id,
+                            res['examples'],
+                            layers,
+                            FeatureStatistics.from_rows(*res['ids']),
+                            encoder,
+                            subset,
+                            spill),
+                        inputs=(
+                            'pk2id.source',
+                            'pk2id.language',
+                            'pk2id.parameter',
+                            'subset',
+                            'example_by_value'),
+                        outputs=('ValueTable',)),
+                ],
+                workers=self.options.workers,
+            )
+        finally:  # Finalize the ZIP archives, even if a stage failed.
+            media.close()
+        sources, contributors = results['sources'], results['contributors']
+        args.writer.objects['contributors.csv'] = contributors.contributors
+        for stage_objects in objects.values():
+            for key, rows in stage_objects.items():
+                if args.writer.objects.get(key):
+                    args.writer.objects[key].extend(rows)
+                else:  # Don't copy rows, which may have been spilled to disk.
+                    args.writer.objects[key] = rows
+        args.writer.objects['LanguageTable'].sort(key=lambda d: d['ID'])
+
+        if subset:  # Only keep sources and contributors which are referenced.
+            refs = {
+                ref.split('[')[0]
+                for rows in args.writer.objects.values() for row in rows
+                for ref in row.get('Source') or []}
+            sources = [src for src in sources if src.id in refs]
+            cids = {
+                cid for row in args.writer.objects['ContributionTable']
+                for cid in row['Contributor_IDs']}
+            args.writer.objects['contributors.csv'] = [
+                row for row in contributors.contributors if row['ID'] in cids]
+        args.writer.cldf.add_sources(*sources)
+
+        errors = check_integrity(args.writer.objects, [src.id for src in sources])
+        for error in errors:
+            args.log.error(error)
+        if errors:
+            raise ValueError('Referential integrity check failed')
+        if not subset:
+            for msg in check_counts(
+                    args.writer.cldf, args.writer.objects, load(self.etc_dir / 'counts.json')):
+                args.log.warning(msg)
+
+        if self.options.columnar_export:
+            write_columnar(args.writer.cldf, args.writer.objects, self.options.columnar_export)
+        if self.options.map_layers:
+            layers.write(self.options.map_layers)
+        if references:
+            args.log.info('references: {}'.format(references.write(self.cldf_dir)))
+        write_citations(
+            args.writer.objects['ContributionTable'],
+            contributors,
+            self.read('survey'),
+            self.cldf_dir / 'citations.json')
+
+    def _read_sources(self, pk2id: PkMapType) -> list[Source]:
+        sources = list(self.itersources(pk2id))
         self.read('source', pkmap=pk2id)
+        return sources
+
+    def _read_contributors(self, pk2id: PkMapType) -> Contributors:
+        from mediautil import Contributors
 
-        contributors = Contributors.from_contrib_rows(
+        return Contributors.from_contrib_rows(
             self.read('contributor', pkmap=pk2id, key=lambda r: r['id']).values(),
             self.contributor_ids('contributioncontributor', pk2id, 'contribution_pk'),
             self.contributor_ids('surveycontributor', pk2id, 'survey_pk'),
             self.contributor_ids('featureauthor', pk2id, 'feature_pk'),
         )
-        args.writer.objects['contributors.csv'] = contributors.contributors
 
-        index = TableOfContents()
-        self._add_languages(args.writer.objects, pk2id, media, contributors, index)
-        args.writer.objects['LanguageTable'].sort(key=lambda d: d['ID'])
+    def _read_ids(self, pk2id: PkMapType, subset: Subset):
+        """
+        Read the IDs of languages and parameters.
 
-        for row in self.read(
-                'parameter',
-                extended='feature',
-                pkmap=pk2id,
-                key=lambda d: int(d['id'])).values():
-            self._add_feature(row, args.writer.objects, media, contributors, index)
+        :return: Pair (language rows, parameter rows).
 
-        index.write(self.cldf_dir / 'index.html')
-        example_by_value = self._add_examples(args.writer.objects, pk2id, media)
-        self._add_values(args.writer.objects, pk2id, example_by_value)
+        Note: A selection of languages in `subset` is extended to include related lects and
+        languages described in the same survey.
+        """
+        from mediautil import LanguageContributions
+
+        rows = self.read('language', extended='lect', pkmap=pk2id)
+        parameters = self.read('parameter', extended='feature', pkmap=pk2id)
+        if subset.languages:
+            contribs = LanguageContributions.from_surveys_and_contribs(
+                self.read('survey'),
+                self.read('contribution', extended='apicscontribution'))
+            for lid in list(subset.languages):
+                subset.languages.update(contribs.contributions(lid).survey_lids())
+            lects = [
+                (row['id'], pk2id['language'][row['language_pk']])
+                for row in rows.values() if row['language_pk']]
+            subset.languages.update(d for lid, d in lects if lid in subset.languages)
+            subset.languages.update(lid for lid, d in lects if d in subset.languages)
+        return rows, parameters
+
+    def _optimize_images(self, subset: Subset):
+        """
+        Optimize the survey maps and create thumbnails.
+
+        :return: `dict` mapping paths of the original maps to pairs (optimized map, thumbnail or \
+        `None`).
+        """
+        from mediautil import optimize_images
+
+        if not self.options.optimize_images:
+            return {}
+        return optimize_images(
+            [
+                p for p in sorted(self.raw_dir.joinpath('Surveys').glob('*-*.png'))
+                if 'figure' not in p.stem and subset.language(p.stem.split('-')[0])],
+            self.dir / '.cache' / 'images',
+            workers=self.options.workers)
+
+    def _add_features(
+            self,
+            objects: ObjectsType,
+            media: MediaTable,
+            contributors: Contributors,
+            index: TableOfContents,
+            encoder: MetadataEncoder,
+            subset: Subset,
+            references: typing.Optional[ReferenceStore],
+    ):
+        for row in self.read('parameter', extended='feature', key=lambda d: int(d['id'])).values():
+            if subset.parameter(row['id']):
+                self._add_feature(row, objects, media, contributors, index, encoder, references)
 
     def _add_values(
             self,
             objects: ObjectsType,
             pk2id: PkMapType,
             example_by_value,
+            layers: MapLayers,
+            stats: FeatureStatistics,
+            encoder: MetadataEncoder,
+            subset: Subset,
+            spill: typing.Optional[SpillStore],
     ):
         for row in self.read(
                 'domainelement',
                 pkmap=pk2id,
                 key=lambda d: (int(d['id'].split('-')[0]), int(d['number']))).values():
+            if not subset.parameter(pk2id['parameter'][row['parameter_pk']]):
+                continue
             objects['CodeTable'].append({
                 'ID': row['id'],
                 'Parameter_ID': pk2id['parameter'][row['parameter_pk']],
@@ -170,13 +425,17 @@ APiCS covers 76 pidgin and creole languages from around the world.
                 'color': row['jsondata']['color'],
                 'abbr': row['abbr'],
             })
+            layers.add_code(objects['CodeTable'][-1])
 
         refs = dict(self._get_refs('valueset', pk2id))
-        vsdict = self.read('valueset', pkmap=pk2id)
+        vsdict = self.read_large('valueset', spill, pkmap=pk2id)
 
-        for row in self.read('value').values():
+        for row in self.read_large('value', spill).values():
             vs = vsdict[row['valueset_pk']]
-            objects['ValueTable'].append({
+            if not subset.value(
+                    pk2id['language'][vs['language_pk']], pk2id['parameter'][vs['parameter_pk']]):
+                continue
+            value = {
                 'ID': row['id'],
                 'Language_ID': pk2id['language'][vs['language_pk']],
                 'Parameter_ID': pk2id['parameter'][vs['parameter_pk']],
@@ -187,17 +446,44 @@ APiCS covers 76 pidgin and creole languages from around the world.
                 'Example_ID': example_by_value.get(row['pk'], []),
                 'Frequency': float(row['frequency']) if row['frequency'] else None,
                 'Confidence': CONFIDENCE_FIX.get(row['confidence'], row['confidence']),
-                'Metadata': json.dumps(collections.OrderedDict(
-                    sorted(vs['jsondata'].items(), key=lambda i: i[0]))),
+                'Metadata': encoder(vs['jsondata']),
                 'source_comment': vs['source'],
-            })
+            }
+            objects['ValueTable'].append(value)
+            layers.add_value(value, vs['jsondata'].get('icon'))
+            stats.add(value)
 
         objects['ValueTable'].sort(key=lambda d: (d['Language_ID'], d['Parameter_ID']))
+        objects['featurestatistics.csv'].extend(stats.rows())
+
+    def _add_examples(
+            self,
+            objects: ObjectsType,
+            pk2id: PkMapType,
+            media: MediaTable,
+            subset: Subset,
+            spill: typing.Optional[SpillStore],
+    ):
+        example_by_value = {
+            vpk: [r['sentence_pk'] for r in rows]
+            for vpk, rows in itertools.groupby(
+                self.read('valuesentence', key=lambda d: d['value_pk']).values(),
+                lambda d: d['value_pk'])}
+        if subset:  # Only add examples referenced by selected values.
+            vsdict = self.read_large('valueset', spill)
+            epks = {
+                epk for row in self.read_large('value', spill).values()
+                if subset.value(
+                    pk2id['language'][vsdict[row['valueset_pk']]['language_pk']],
+                    pk2id['parameter'][vsdict[row['valueset_pk']]['parameter_pk']])
+                for epk in example_by_value.get(row['pk'], [])}
 
-    def _add_examples(self, objects: ObjectsType, pk2id: PkMapType, media: MediaTable):
         exrefs = dict(self._get_refs('sentence', pk2id))
         igts = {}
         for ex in self.read('sentence', pkmap=pk2id).values():
+            if subset and not (
+                    ex['pk'] in epks and subset.language(pk2id['language'][ex['language_pk']])):
+                continue
             audio, a, g = None, [], []
             files = ex.get('files', [])
             if files:
@@ -241,13 +527,9 @@ APiCS covers 76 pidgin and creole languages from around the world.
         for row in self.read('glossabbreviation').values():
             objects['glossabbreviations.csv'].append(
                 dict(ID=row['id'], Name=row['name']))
-        example_by_value = {
-            vpk: [r['sentence_pk'] for r in rows]
-            for vpk, rows in itertools.groupby(
-                self.read('valuesentence', key=lambda d: d['value_pk']).values(),
-                lambda d: d['value_pk'])}
+        # Only subset builds skip examples, otherwise references to missing examples are errors.
         return {
-            vpk: sorted(igts[epk] for epk in epks)
+            vpk: sorted(igts[epk] for epk in epks if not subset or epk in igts)
             for vpk, epks in example_by_value.items()}
 
     def _add_languages(
@@ -257,7 +539,13 @@ APiCS covers 76 pidgin and creole languages from around the world.
             media: MediaTable,
             contributors: Contributors,
             index: TableOfContents,
+            layers: MapLayers,
+            subset: Subset,
+            images: dict[pathlib.Path, tuple[pathlib.Path, typing.Optional[pathlib.Path]]],
+            references: typing.Optional[ReferenceStore],
     ):
+        from mediautil import LanguageMetadata, LanguageContributions
+
         lmeta = LanguageMetadata.from_csv(self.read, pk2id)
         contribs = LanguageContributions.from_surveys_and_contribs(
             self.read('survey'),
@@ -267,9 +555,10 @@ APiCS covers 76 pidgin and creole languages from around the world.
         for row in self.read(
                 'language',
                 extended='lect',
-                pkmap=pk2id,
                 key=lambda l: (bool(l['language_pk']), int(l['id'])),
         ).values():
+            if not subset.language(row['id']):
+                continue
             self._add_language(
                 row,
                 lmeta,
@@ -278,6 +567,9 @@ APiCS covers 76 pidgin and creole languages from around the world.
                 contributors,
                 media,
                 index,
+                layers,
+                images,
+                references,
             )
 
     def _add_language(
@@ -289,7 +581,13 @@ APiCS covers 76 pidgin and creole languages from around the world.
             contributors,
             media: MediaTable,
             index: TableOfContents,
+            layers: MapLayers,
+            images: dict[pathlib.Path, tuple[pathlib.Path, typing.Optional[pathlib.Path]]],
+            references: typing.Optional[ReferenceStore],
     ):
+        from clldutils.html import HTML
+        from mediautil import contribution_media
+
         meta.pk2id[row['pk']] = row['id']
         assert contribs.survey or (int(row['id']) == 21 or int(row['id']) > 100)
         objects['LanguageTable'].append(meta.update(
@@ -305,6 +603,7 @@ APiCS covers 76 pidgin and creole languages from around the world.
                 'Lexifier': row['lexifier'],
             },
             row['pk']))
+        layers.add_language(objects['LanguageTable'][-1])
         if meta.pk2id.get(row['language_pk']):
             return
         # Create the two related contributions: StructureDataset and SurveyChapter
@@ -330,17 +629,27 @@ APiCS covers 76 pidgin and creole languages from around the world.
                     extra.append(HTML.p(HTML.a('[PDF]', href=gt_pdf)))
                 extra = HTML.div(*extra)
 
-            html, maps = contribution_media(self.etc_dir, self.raw_dir / 'Surveys', row['id'], extra_section=extra)
+            html, maps, fragments = contribution_media(
+                self.etc_dir, self.raw_dir / 'Surveys', row['id'],
+                extra_section=extra,
+                thumbnails={
+                    src.name: thumbnail.name for src, (_, thumbnail) in images.items() if thumbnail
+                } if images else None,
+                sectioned=self.options.sectioned_chapters,
+                references=references)
             sid = f"s-{row['id']}"
+            for name, fragment in fragments.items():  # Fragments are part of the chapter page.
+                media.store(self.write_file('Survey', name, fragment))
             media.add(
                 self.write_file('Survey', survey_html.name, html),
                 contribs.survey['name'],
                 cid=sid, lids=contribs.survey_lids())
             for src in maps:
-                media.add(
-                    src,
-                    f"Map or figure accompanying language survey {contribs.survey['name']}",
-                    dest='Survey', cid=sid, lids=contribs.survey_lids())
+                desc = f"Map or figure accompanying language survey {contribs.survey['name']}"
+                src, thumbnail = images.get(src, (src, None))
+                if thumbnail:  # Thumbnails are renditions, not media objects in their own right.
+                    media.store(thumbnail, dest='Survey')
+                media.add(src, desc, dest='Survey', cid=sid, lids=contribs.survey_lids())
 
     def _add_feature(
             self,
@@ -348,7 +657,9 @@ APiCS covers 76 pidgin and creole languages from around the world.
             objects: ObjectsType,
             media: MediaTable,
             contributors,
-            index: TableOfContents):
+            index: TableOfContents,
+            encoder: MetadataEncoder,
+            references: typing.Optional[ReferenceStore]):
         """
         A feature in APiCS is considered a citeable contribution. Thus, adding a feature means
         adding
@@ -356,6 +667,8 @@ APiCS covers 76 pidgin and creole languages from around the world.
         - a Contributio
         - possibly media files: a map in Gall-Peters projection and/or the chapter text.
         """
+        from mediautil import contribution_media
+
         objects['ParameterTable'].append({
             'ID': row['id'],
             'Name': row['name'],
@@ -368,8 +681,7 @@ APiCS covers 76 pidgin and creole languages from around the world.
             'WALS_ID': (row['wals_id'] + 'A') if row['wals_id'] else '',
             'WALS_Representation': int(row['wals_representation']) if row['wals_representation'] else None,
             'Area': row['area'],
-            'metadata': json.dumps(collections.OrderedDict(
-                sorted(row['jsondata'].items(), key=lambda i: i[0]))),
+            'metadata': encoder(row['jsondata']),
         })
         obj = contributors.contrib_spec(contributors.fc_ids.get(row['pk'], []))
         obj.update({
@@ -395,10 +707,14 @@ APiCS covers 76 pidgin and creole languages from around the world.
         chapter_name = f"{row['id']}.html"
         if self.raw_dir.joinpath('Atlas', chapter_name).exists():
             index.add_atlas_chapter(row, chapter_name)
-            html, maps = contribution_media(
+            html, maps, fragments = contribution_media(
                 self.etc_dir, self.raw_dir / 'Atlas', row['id'],
-                title=row['name'], author=obj['Contributor'])
+                title=row['name'], author=obj['Contributor'],
+                sectioned=self.options.sectioned_chapters,
+                references=references)
             assert not maps
+            for name, fragment in fragments.items():
+                media.store(self.write_file('Atlas', name, fragment))
             media.add(self.write_file('Atlas', chapter_name, html), row['name'], cid=obj['ID'])
 
     def _get_refs(self, referent: typing.Literal['valueset', 'sentence'], pk2id: PkMapType):
@@ -417,6 +733,8 @@ APiCS covers 76 pidgin and creole languages from around the world.
             yield rpk, [str(_reference_from_row(row)) for row in rows if row['source_pk']]
 
     def create_schema(self, cldf, media: MediaTable):
+        from exportutil import FeatureStatistics
+
         cldf.add_component(
             'LanguageTable',
             {
@@ -580,6 +898,7 @@ APiCS covers 76 pidgin and creole languages from around the world.
             },
             'source_comment',
         )
+        FeatureStatistics.schema(cldf)
 
     def read(self, core, extended=False, pkmap=None, key=None):
         if not key:
@@ -606,6 +925,22 @@ APiCS covers 76 pidgin and creole languages from around the world.
                     res[opk]['files'].append(row)
         return res
 
+    def read_large(self, core, spill, pkmap=None) -> typing.Mapping[str, dict]:
+        """
+        Read a large table - without extensions or files - like `read`, but keep the rows on disk
+        if a `SpillStore` is passed.
+        """
+        if not spill:
+            return self.read(core, pkmap=pkmap)
+        rows = spill.list()
+        for row in dsv.reader(self.raw_dir / '{0}.csv'.format(core), dicts=True):
+            row['jsondata'] = json.loads(row.get('jsondata') or '{}')
+            rows.append(row)
+            if pkmap is not None:
+                pkmap[core][row['pk']] = row['id']
+        rows.sort(key=lambda d: int(d['pk']))
+        return spill.mapping((row['pk'], row) for row in rows)
+
     def itersources(self, pkmap):
         for row in self.raw_dir.read_csv('source.csv', dicts=True):
             jsondata = json.loads(row.pop('jsondata', '{}') or '{}')
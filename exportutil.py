@@ -0,0 +1,500 @@
+"""
+Additional, derived data: Aggregated tables added to the CLDF dataset, and exports written
+alongside the CLDF dataset by `cldfbench makecldf` if requested via `buildutil.BuildOptions`.
+"""
+import re
+import json
+import math
+import shutil
+import typing
+import pathlib
+import itertools
+import collections
+import dataclasses
+
+from clldutils.misc import slug
+
+COLUMNAR_TABLES = {
+    'ValueTable': 'values',
+    'ExampleTable': 'examples',
+    'LanguageTable': 'languages',
+}
+ARROW_TYPES = {
+    'integer': 'int64',
+    'number': 'float64',
+    'float': 'float64',
+    'decimal': 'float64',
+    'boolean': 'bool_',
+}
+
+
+def arrow_schema(table):
+    """
+    Translate the tableSchema of a CLDF table into an Arrow schema.
+
+    Reference columns (e.g. `Language_ID`, `Parameter_ID`, `Code_ID`) are dictionary-encoded,
+    list-valued columns become Arrow lists.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for col in table.tableSchema.columns:
+        base = col.datatype.base if col.datatype else 'string'
+        type_ = getattr(pa, ARROW_TYPES.get(base, 'string'))()
+        if col.separator:
+            type_ = pa.list_(type_)
+        elif str(col.propertyUrl or '').endswith('Reference'):
+            type_ = pa.dictionary(pa.int32(), type_)
+        fields.append(pa.field(col.name, type_))
+    return pa.schema(fields)
+
+
+def _value(field, v):
+    import pyarrow as pa
+
+    if v == '':
+        return None
+    # Some numbers, e.g. coordinates, are passed as strings from the raw data.
+    if v is not None and pa.types.is_floating(field.type):
+        return float(v)
+    if v is not None and pa.types.is_integer(field.type):
+        return int(v)
+    return v
+
+
+def _write_arrow(path: pathlib.Path, schema, rows, batch_size=50000):
+    import pyarrow as pa
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = iter(rows)
+    batches = []
+    # Convert rows in batches, to not hold a second copy of large tables as Python objects.
+    while True:
+        batch = [
+            {f.name: _value(f, row.get(f.name)) for f in schema}
+            for row in itertools.islice(rows, batch_size)]
+        if not batch:
+            break
+        batches.append(pa.RecordBatch.from_pylist(batch, schema=schema))
+    # Each batch has its own dictionaries, but the IPC file format allows only one per column.
+    table = pa.Table.from_batches(batches, schema=schema).unify_dictionaries()
+    # We write uncompressed Arrow IPC files, so that the data can be memory-mapped.
+    with pa.OSFile(str(path), 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+
+
+def _sorted(rows, key):
+    # Tables spilled to disk - see `buildutil.SpillList` - are sorted on disk.
+    return rows.sorted(key) if hasattr(rows, 'sorted') else sorted(rows, key=key)
+
+
+def write_columnar(cldf, objects, directory: pathlib.Path):
+    """
+    Write ValueTable, ExampleTable and LanguageTable as Arrow IPC files, and ValueTable also
+    partitioned by parameter, as `values/<Parameter_ID>.arrow`.
+    """
+    if directory.exists():
+        shutil.rmtree(directory)
+    for component, name in COLUMNAR_TABLES.items():
+        schema = arrow_schema(cldf[component])
+        _write_arrow(directory / f'{name}.arrow', schema, objects[component])
+        if component == 'ValueTable':
+            for pid, rows in itertools.groupby(
+                _sorted(objects[component], key=lambda r: r['Parameter_ID']),
+                lambda r: r['Parameter_ID'],
+            ):
+                _write_arrow(directory / name / f'{pid}.arrow', schema, rows)
+
+
+ICON_SIZE = 20
+
+
+def icon_slices(name: str) -> list[tuple[float, str]]:
+    """
+    Slices of the pie chart depicted by an icon, given as pairs (percentage, color), e.g.
+    `pie-50-FF0000-50-0000FF` or - for frequency icons - `freq-60`.
+    """
+    if name.startswith('freq-'):
+        pct = float(name.split('-')[1])
+        return [(pct, '000000'), (100 - pct, 'FFFFFF')]
+    return [(float(pct), color) for pct, color in re.findall(r'-([0-9.]+)-([0-9A-Fa-f]{6})', name)]
+
+
+def pie_svg(slices: list[tuple[float, str]], x: float = 0, y: float = 0, size: int = ICON_SIZE):
+    """
+    SVG markup for a pie chart with slices drawn clockwise from 12 o'clock.
+    """
+    r = size / 2 - 0.5
+    cx, cy = x + size / 2, y + size / 2
+    slices = [(pct, color) for pct, color in slices if pct > 0]
+    total = sum(pct for pct, _ in slices)
+
+    def point(fraction):
+        angle = 2 * math.pi * fraction - math.pi / 2
+        return '{:.2f},{:.2f}'.format(cx + r * math.cos(angle), cy + r * math.sin(angle))
+
+    res, start = [], 0
+    for pct, color in slices:
+        if pct >= total:
+            res.append(f'<circle cx="{cx}" cy="{cy}" r="{r}" fill="#{color}"/>')
+            break
+        end = start + pct / total
+        res.append('<path d="M{},{} L{} A{},{} 0 {} 1 {} Z" fill="#{}"/>'.format(
+            cx, cy, point(start), r, r, 1 if end - start > 0.5 else 0, point(end), color))
+        start = end
+    res.append(f'<circle cx="{cx}" cy="{cy}" r="{r}" fill="none" stroke="#000000"/>')
+    return ''.join(res)
+
+
+def write_sprite(names, directory: pathlib.Path, size: int = ICON_SIZE):
+    """
+    Render the icons as one SVG sprite sheet, laid out as grid, `icons.svg`, and write the
+    coordinates of the icons - in the format of Mapbox sprite indexes - as `icons.json`.
+
+    Each icon can also be referenced as SVG fragment, e.g. `icons.svg#pie-100-FFFFFF`.
+    """
+    names = sorted(names)
+    columns = max(math.ceil(math.sqrt(len(names))), 1)
+    width, height = columns * size, math.ceil(len(names) / columns) * size
+    index, views, icons = {}, [], []
+    for i, name in enumerate(names):
+        x, y = (i % columns) * size, (i // columns) * size
+        index[name] = dict(x=x, y=y, width=size, height=size, pixelRatio=1)
+        views.append(f'<view id="{name}" viewBox="{x} {y} {size} {size}"/>')
+        icons.append(pie_svg(icon_slices(name), x, y, size))
+    directory.joinpath('icons.svg').write_text(
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}">'
+        '{2}{3}</svg>'.format(width, height, ''.join(views), ''.join(icons)),
+        encoding='utf8')
+    _dump(index, directory / 'icons.json')
+
+
+def _dump(obj, path: pathlib.Path):
+    path.write_text(json.dumps(obj, separators=(',', ':'), ensure_ascii=False), encoding='utf8')
+
+
+@dataclasses.dataclass
+class MapLayers:
+    """
+    Precomputed map layers: A point layer with the coordinates of all languages, written once as
+    GeoJSON, and one compact layer per parameter, keyed by Language_ID, which lists the values -
+    Code_ID and frequency as fraction - with the pie icon of the valueset per language. All icons
+    of codes, valuesets and value frequencies are rendered into one sprite sheet.
+
+    Data is collected while the CLDF objects are assembled.
+    """
+    languages: dict[str, dict] = dataclasses.field(default_factory=dict)
+    codes: dict[str, dict[str, dict]] = dataclasses.field(
+        default_factory=lambda: collections.defaultdict(dict))
+    layers: dict[str, dict[str, dict]] = dataclasses.field(
+        default_factory=lambda: collections.defaultdict(dict))
+    icons: set[str] = dataclasses.field(default_factory=set)
+
+    def add_language(self, lang: dict):
+        if lang['Latitude'] and lang['Longitude']:
+            self.languages[lang['ID']] = {
+                'type': 'Feature',
+                'id': lang['ID'],
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [float(lang['Longitude']), float(lang['Latitude'])]},
+                'properties': {
+                    k: lang[k] for k in ['Name', 'Region', 'Lexifier', 'Default_Lect_ID']},
+            }
+
+    def add_code(self, code: dict):
+        self.codes[code['Parameter_ID']][code['ID']] = {
+            k: code[k] for k in ['Name', 'Number', 'icon', 'color']}
+        self.icons.add(pathlib.Path(code['icon']).stem)
+
+    def add_value(self, value: dict, icon: str):
+        entry = self.layers[value['Parameter_ID']].setdefault(
+            value['Language_ID'], {'icon': icon, 'values': []})
+        entry['values'].append([
+            value['Code_ID'],
+            value['Frequency'] / 100 if value['Frequency'] is not None else None])
+        if icon:
+            self.icons.add(pathlib.Path(icon).stem)
+        if value['Frequency'] is not None:
+            self.icons.add(f"freq-{math.ceil(value['Frequency'])}")
+
+    def write(self, directory: pathlib.Path):
+        if directory.exists():
+            shutil.rmtree(directory)
+        directory.mkdir(parents=True)
+        _dump(
+            {'type': 'FeatureCollection',
+             'features': [self.languages[lid] for lid in sorted(self.languages)]},
+            directory / 'languages.geojson')
+        for pid, layer in self.layers.items():
+            _dump(
+                {
+                    'Parameter_ID': pid,
+                    'codes': self.codes[pid],
+                    'languages': {
+                        lid: dict(icon=v['icon'], values=sorted(v['values']))
+                        for lid, v in sorted(layer.items()) if lid in self.languages},
+                },
+                directory / f'{pid}.json')
+        write_sprite(self.icons, directory)
+
+
+@dataclasses.dataclass
+class FeatureStatistics:
+    """
+    Distribution of the values of each feature, overall and broken down by lexifier and region of
+    the languages, counting either only default lects or all lects. Values are weighted by their
+    frequency, i.e. each language contributes a total weight of 1 to a feature.
+
+    Aggregates are updated for each value while the ValueTable is assembled.
+    """
+    groups: dict[str, dict[str, str]]
+    default_lects: set[str]
+    areas: dict[str, str]
+    counts: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+    weights: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+    totals: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+
+    @classmethod
+    def from_rows(cls, languages: dict[str, dict], parameters: dict[str, dict]):
+        """
+        :param languages: Rows of the raw language table - extended with lect - keyed by pk.
+        :param parameters: Rows of the raw parameter table - extended with feature.
+        """
+        groups, default_lects = {}, set()
+        for row in languages.values():
+            if row['language_pk']:  # Non-default lects inherit the region of the default lect.
+                default = languages[row['language_pk']]
+            else:
+                default = row
+                default_lects.add(row['id'])
+            groups[row['id']] = {
+                'All': 'All',
+                'Lexifier': row['lexifier'],
+                'Region': row['region'] or default['region']}
+        return cls(groups, default_lects, {row['id']: row['area'] for row in parameters.values()})
+
+    @staticmethod
+    def schema(cldf):
+        t = cldf.add_table(
+            'featurestatistics.csv',
+            {
+                'name': 'ID',
+                'propertyUrl': 'http://cldf.clld.org/v1.0/terms.rdf#id',
+            },
+            {
+                'name': 'Parameter_ID',
+                'propertyUrl': 'http://cldf.clld.org/v1.0/terms.rdf#parameterReference',
+            },
+            {
+                'name': 'Code_ID',
+                'propertyUrl': 'http://cldf.clld.org/v1.0/terms.rdf#codeReference',
+            },
+            'Area',
+            {
+                'name': 'Dimension',
+                'dc:description':
+                    'The property of languages by which values are grouped: Lexifier, Region or '
+                    'All, i.e. no grouping.',
+            },
+            'Group',
+            {
+                'name': 'Lects',
+                'dc:description': 'Whether only default lects or all lects are counted.',
+            },
+            {
+                'name': 'Count',
+                'datatype': 'integer',
+                'dc:description': 'Number of values with this code.',
+            },
+            {
+                'name': 'Weight',
+                'datatype': 'number',
+                'dc:description': 'Sum of the frequencies - as fractions - of values with this code.',
+            },
+            {
+                'name': 'Share',
+                'datatype': 'number',
+                'dc:description': 'Weight of the code relative to the weight of all codes of the '
+                                  'feature in the group.',
+            },
+            description='Distribution of values per feature, by lexifier and region.',
+        )
+        t.common_props['dc:conformsTo'] = None
+
+    def add(self, value: dict):
+        lid = value['Language_ID']
+        weight = value['Frequency'] / 100 if value['Frequency'] is not None else 1
+        for lects in ['default', 'all'] if lid in self.default_lects else ['all']:
+            for dimension, group in self.groups[lid].items():
+                if group:
+                    key = (value['Parameter_ID'], dimension, group, lects)
+                    self.counts[key + (value['Code_ID'],)] += 1
+                    self.weights[key + (value['Code_ID'],)] += weight
+                    self.totals[key] += weight
+
+    def rows(self):
+        dimensions = ['All', 'Lexifier', 'Region']
+        for key in sorted(
+            self.counts,
+            key=lambda k: (
+                int(k[0]), dimensions.index(k[1]), k[2], k[3], int(k[4].split('-')[1])),
+        ):
+            pid, dimension, group, lects, cid = key
+            yield {
+                'ID': '-'.join([cid, slug(dimension), slug(group), lects]),
+                'Parameter_ID': pid,
+                'Code_ID': cid,
+                'Area': self.areas.get(pid),
+                'Dimension': dimension,
+                'Group': group,
+                'Lects': lects,
+                'Count': self.counts[key],
+                'Weight': round(self.weights[key], 4),
+                'Share': round(self.weights[key] / self.totals[key[:4]], 4),
+            }
+
+
+CONTAINERS = {
+    'AtlasChapter': 'The Atlas of Pidgin and Creole Language Structures',
+    'SurveyChapter': 'The survey of pidgin and creole languages',
+    'StructureDataset': 'Atlas of Pidgin and Creole Language Structures Online',
+}
+OUP = ('Oxford University Press', 'Oxford')
+EVA = ('Max Planck Institute for Evolutionary Anthropology', 'Leipzig')
+
+
+@dataclasses.dataclass
+class Citation:
+    """
+    Structured bibliographic record of a contribution, i.e. the data of the `Citation` column of
+    the ContributionTable, which can be rendered as BibTeX, RIS or CSL-JSON.
+    """
+    id: str
+    type: str
+    title: str
+    container: str
+    authors: list[tuple[str, str]]  # Pairs (family name, given names); organizations are literal.
+    editors: list[tuple[str, str]]
+    publisher: str
+    place: str
+    year: str = '2013'
+    volume: typing.Optional[str] = None
+    url: typing.Optional[str] = None
+
+    @classmethod
+    def from_contribution(cls, row: dict, contributors, surveys: dict[str, dict]) -> 'Citation':
+        """
+        :param row: Row of the ContributionTable.
+        :param contributors: `mediautil.Contributors` instance.
+        :param surveys: Rows of the raw survey table, keyed by ID.
+        """
+        kw = dict(
+            id=row['ID'],
+            type=row['type'],
+            title=row['Name'],
+            container=CONTAINERS[row['type']],
+            authors=[
+                contributors.split_name(contributors.cnames[cid])
+                for cid in row['Contributor_IDs']],
+            editors=[contributors.split_name(name) for name in contributors.editors])
+        if row['type'] == 'AtlasChapter':
+            kw['authors'].append(('APiCS Consortium', None))
+            publisher, place = OUP
+        elif row['type'] == 'SurveyChapter':
+            survey = surveys[row['ID'].split('-')[1]]
+            kw['title'] = survey['name']
+            # Survey volumes are described like "Volume 1: English-based and Dutch-based Languages".
+            kw['container'] = '{}. {}'.format(kw['container'], survey['description'])
+            kw['volume'] = re.match(r'Volume\s+([0-9]+)', survey['description']).groups()[0]
+            publisher, place = OUP
+        else:
+            kw['url'] = 'https://apics-online.info/contributions/{}'.format(row['ID'])
+            publisher, place = EVA
+        return cls(publisher=publisher, place=place, **kw)
+
+    @staticmethod
+    def _names(names):
+        return [(f'{family}, {given}' if given is not None else family) for family, given in names]
+
+    def bibtex(self) -> str:
+        from pycldf.sources import Source
+
+        fields = dict(
+            # Organizations are braced, so that they are not parsed as personal names.
+            author=' and '.join(
+                f'{family}, {given}' if given is not None else '{%s}' % family
+                for family, given in self.authors),
+            editor=' and '.join(self._names(self.editors)),
+            title=self.title,
+            booktitle=self.container,
+            volume=self.volume,
+            year=self.year,
+            publisher=self.publisher,
+            address=self.place,
+            url=self.url,
+        )
+        return Source('incollection', self.id, **{k: v for k, v in fields.items() if v}).bibtex()
+
+    def ris(self) -> str:
+        lines = [('TY', 'CHAP' if self.type != 'StructureDataset' else 'DATA'), ('ID', self.id)]
+        lines.extend(('AU', name) for name in self._names(self.authors))
+        lines.extend([('TI', self.title), ('T2', self.container)])
+        lines.extend(('A2', name) for name in self._names(self.editors))
+        lines.extend([
+            ('VL', self.volume),
+            ('PY', self.year),
+            ('PB', self.publisher),
+            ('CY', self.place),
+            ('UR', self.url),
+            ('ER', '')])
+        return ''.join(f'{tag}  - {value}\r\n' for tag, value in lines if value is not None)
+
+    def csl(self) -> dict:
+        def name(family, given):
+            if given is None:
+                return {'literal': family}
+            res = {'family': family, 'given': given}
+            # Particles - e.g. "van den" in "van den Berg" - are passed separately, so that CSL
+            # styles can decide whether to sort by them.
+            particle, _, rest = family.rpartition(' ')
+            if particle and particle[0].islower():
+                res.update({'family': rest, 'non-dropping-particle': particle})
+            return res
+
+        def names(names):
+            return [name(family, given) for family, given in names]
+
+        res = {
+            'id': self.id,
+            'type': 'chapter' if self.type != 'StructureDataset' else 'dataset',
+            'title': self.title,
+            'container-title': self.container,
+            'author': names(self.authors),
+            'editor': names(self.editors),
+            'issued': {'date-parts': [[int(self.year)]]},
+            'publisher': self.publisher,
+            'publisher-place': self.place,
+            'volume': self.volume,
+            'URL': self.url,
+        }
+        return {k: v for k, v in res.items() if v is not None}
+
+
+def write_citations(contributions, contributors, surveys: dict[str, dict], path: pathlib.Path):
+    """
+    Write citations of all contributions in all supported formats to a JSON object keyed by
+    contribution ID, i.e. serving a citation only requires a lookup.
+    """
+    surveys = {row['id']: row for row in surveys.values()}
+    res = collections.OrderedDict()
+    for row in contributions:
+        citation = Citation.from_contribution(row, contributors, surveys)
+        res[citation.id] = {
+            'text': row['Citation'],
+            'bibtex': citation.bibtex(),
+            'ris': citation.ris(),
+            'csl': citation.csl(),
+        }
+    _dump(res, path)
@@ -1,11 +1,18 @@
+import os
 import json
+import uuid
 import shutil
+import hashlib
 import pathlib
+import zipfile
+import threading
 import functools
 import mimetypes
 import itertools
 import collections
 import dataclasses
+import multiprocessing
+import concurrent.futures
 from typing import Optional
 
 from clldutils.path import md5
@@ -180,6 +187,18 @@ class Contributors:
     sc_ids: dict[str, list[str]]
     fc_ids: dict[str, list[str]]
 
+    @staticmethod
+    def split_name(name: str) -> tuple[str, str]:
+        """
+        Split a name into (family name, given names), where the family name includes lowercase
+        particles, e.g. "Margot C. van den Berg" into ("van den Berg", "Margot C.").
+        """
+        tokens = name.split()
+        i = len(tokens) - 1
+        while i > 1 and tokens[i - 1][0].islower():
+            i -= 1
+        return ' '.join(tokens[i:]), ' '.join(tokens[:i])
+
     @functools.cached_property
     def editor_names(self):
         return ' & '.join(f"{n.split()[-1]}, {' '.join(n.split()[:-1])}" for n in self.editors)
@@ -223,12 +242,22 @@ class Contributors:
 
 @dataclasses.dataclass
 class MediaTable:
+    """
+    Media objects are either copied as individual files into a subdirectory of the CLDF directory
+    or - if `zipped` - stored as members of one (uncompressed) ZIP archive per subdirectory, with
+    `Download_URL` pointing to the archive and `Path_In_Zip` specifying the member.
+
+    To add media from multiple threads, each thread should use its own `MediaTable.bind` copy.
+    """
     fname2objid: dict[str, str]
     objects: dict[str, list]
     cldf_dir: pathlib.Path
+    zipped: bool = False
+    archives: dict[str, zipfile.ZipFile] = dataclasses.field(default_factory=dict)
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
 
     @classmethod
-    def from_cdstar(cls, objects, cldf_dir, cdstar):
+    def from_cdstar(cls, objects, cldf_dir, cdstar, zipped=False):
         res = {}
         for oid, md in cdstar.items():
             for bs in md['bitstreams']:
@@ -237,7 +266,7 @@ class MediaTable:
                 # FIXME: make sure we have this in s3!
                 #
                 res[bs['bitstreamid']] = oid
-        return cls(res, objects, cldf_dir)
+        return cls(res, objects, cldf_dir, zipped=zipped)
 
     def schema(self, cldf):
         cldf.add_component(
@@ -259,7 +288,17 @@ class MediaTable:
                 'valueUrl': 'https://s3.nexus.mpcdf.mpg.de/eva-dlce-apics/{File_Key}'
             },
         )
-        cldf.remove_columns('MediaTable', 'Name', 'Path_In_Zip')
+        cldf.remove_columns('MediaTable', 'Name', *([] if self.zipped else ['Path_In_Zip']))
+
+    def bind(self, objects: dict[str, list]) -> 'MediaTable':
+        """A copy collecting rows in `objects`, but sharing archives and lock with `self`."""
+        return dataclasses.replace(self, objects=objects)
+
+    def archive(self, d: str) -> zipfile.ZipFile:
+        if d not in self.archives:
+            self.archives[d] = zipfile.ZipFile(
+                self.cldf_dir / f'{d}.zip', mode='a', compression=zipfile.ZIP_STORED)
+        return self.archives[d]
 
     def add(
             self,
@@ -278,28 +317,303 @@ class MediaTable:
                     return
 
         assert src.exists()
-        self.objects['MediaTable'].append({
+        obj = {
             'ID': md5(src),
             'Description': description,
             'Media_Type': mimetypes.guess_type(src.name)[0],
-            'Download_URL': '/'.join([dest, src.name]) if dest else str(src.relative_to(self.cldf_dir)),
+            'Download_URL': None,
             'size': src.stat().st_size,
             'Contribution_ID': cid,
             'Language_IDs': lids or [],
             'File_Key': f'{self.fname2objid.get(src.name)}_{src.name}' if src.name in self.fname2objid else None,
-        })
+        }
+        obj.update(self.store(src, dest=dest))
+        self.objects['MediaTable'].append(obj)
+
+    def store(self, src: pathlib.Path, dest=None) -> dict[str, str]:
+        """
+        Store a file in the subdirectory `dest` of the CLDF directory (or the corresponding ZIP
+        archive) without adding it to the MediaTable.
+
+        :return: `dict` specifying the `Download_URL` (and `Path_In_Zip`) of the stored file.
+        """
+        path = '/'.join([dest, src.name]) if dest else src.relative_to(self.cldf_dir).as_posix()
+        if self.zipped:
+            d, _, member = path.partition('/')
+            with self.lock:
+                zf = self.archive(d)
+                if member not in zf.NameToInfo:
+                    zf.write(src, arcname=member)
+            if not dest:  # The file has been written to the CLDF directory, so we move it.
+                src.unlink()
+            return {'Download_URL': f'{d}.zip', 'Path_In_Zip': member}
         if dest:
             shutil.copy(src, self.cldf_dir / dest / src.name)
+        return {'Download_URL': path}
 
+    def close(self):
+        """Finalize the ZIP archives, i.e. write their central directories."""
+        for d, zf in self.archives.items():
+            zf.close()
+            if self.cldf_dir.joinpath(d).is_dir() and not any(self.cldf_dir.joinpath(d).iterdir()):
+                self.cldf_dir.joinpath(d).rmdir()
+        self.archives = {}
 
-def get_text(p):
+
+@functools.lru_cache(maxsize=None)
+def _open_archive(path: pathlib.Path) -> zipfile.ZipFile:
+    return zipfile.ZipFile(path)
+
+
+def read_media(cldf_dir: pathlib.Path, obj: dict) -> bytes:
+    """
+    Read the content of a media file, given its MediaTable row.
+
+    Members of ZIP archives are read directly, i.e. by seeking to the offset recorded in the
+    archive's central directory, without extracting the archive.
+    """
+    if obj.get('Path_In_Zip'):
+        return _open_archive(pathlib.Path(cldf_dir) / obj['Download_URL']).read(obj['Path_In_Zip'])
+    return pathlib.Path(cldf_dir).joinpath(obj['Download_URL']).read_bytes()
+
+
+@dataclasses.dataclass
+class MediaCache:
+    """
+    A content-addressed cache of media files, keyed by md5 checksum, which can be shared across
+    checkouts and builds.
+
+    Files are only added to the cache by atomic renames, thus concurrent builds never see partial
+    files. Files are linked from the cache, thus remain available to a checkout when evicted.
+    """
+    directory: pathlib.Path
+    max_size: int
+
+    def path(self, checksum: str) -> pathlib.Path:
+        return self.directory / checksum[:2] / checksum
+
+    def get(self, checksum: str, dest: pathlib.Path) -> bool:
+        """
+        Link the cached file with `checksum` to `dest`.
+
+        :return: Flag signaling whether the file was found in the cache.
+        """
+        p = self.path(checksum)
+        try:
+            os.utime(p)  # Mark the file as recently used.
+            try:
+                os.link(p, dest)
+            except OSError:  # Hard links are not supported or across file systems.
+                shutil.copy(p, dest)
+        except FileNotFoundError:  # Not cached, or evicted concurrently.
+            return False
+        return True
+
+    def put(self, src: pathlib.Path, checksum: str):
+        p = self.path(checksum)
+        if not p.exists():
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.parent / f'{checksum}.{uuid.uuid4().hex}.tmp'
+            shutil.copy(src, tmp)
+            os.replace(tmp, p)
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used files until the cache is within its size limit."""
+        files = []
+        for p in self.directory.glob('*/*'):
+            if p.suffix != '.tmp':
+                try:
+                    files.append((p.stat().st_mtime, p.stat().st_size, p))
+                except FileNotFoundError:  # Evicted concurrently.
+                    pass
+        size = sum(f[1] for f in files)
+        for _, fsize, p in sorted(files):
+            if size <= self.max_size:
+                break
+            p.unlink(missing_ok=True)
+            size -= fsize
+
+
+def thumbnail_name(p: pathlib.Path) -> str:
+    return f'{p.stem}.thumb{p.suffix}'
+
+
+def optimize_image(
+        src: pathlib.Path,
+        directory: pathlib.Path,
+        width: int,
+) -> tuple[pathlib.Path, Optional[pathlib.Path]]:
+    """
+    Recompress a PNG image losslessly and - if it is wider than `width` pixels - create a
+    thumbnail of `width` pixels width with a reduced color palette.
+
+    Results are cached in a subdirectory of `directory` named by the md5 checksum of `src`.
+
+    :return: Pair of paths (optimized image, thumbnail or `None`).
+    """
+    from PIL import Image
+
+    d = directory / md5(src)
+    if not d.exists():
+        tmp = directory / f'{d.name}.{uuid.uuid4().hex}.tmp'
+        tmp.mkdir(parents=True)
+        with Image.open(src) as img:
+            img.save(tmp / src.name, optimize=True)
+            if tmp.joinpath(src.name).stat().st_size >= src.stat().st_size:
+                shutil.copy(src, tmp / src.name)
+            if img.width > width:
+                img.thumbnail((width, img.height))
+                img.quantize(method=Image.Quantize.FASTOCTREE).save(
+                    tmp / thumbnail_name(src), optimize=True)
+        try:
+            os.replace(tmp, d)
+        except OSError:  # Another process was quicker.
+            shutil.rmtree(tmp)
+    thumbnail = d / thumbnail_name(src)
+    return d / src.name, thumbnail if thumbnail.exists() else None
+
+
+def optimize_images(
+        paths: list[pathlib.Path],
+        directory: pathlib.Path,
+        width: int = 400,
+        workers: int = 1,
+) -> dict[pathlib.Path, tuple[pathlib.Path, Optional[pathlib.Path]]]:
+    """Run `optimize_image` for `paths` on a process pool."""
+    # We may be called from a thread, so we don't fork.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        res = dict(zip(
+            paths,
+            pool.map(optimize_image, paths, itertools.repeat(directory), itertools.repeat(width))))
+
+    # Some maps are pixel-identical, differing only in metadata. Since media objects are
+    # identified by md5 checksum, we keep the original files for these.
+    by_checksum = collections.defaultdict(list)
+    for src, (image, _) in res.items():
+        by_checksum[md5(image)].append(src)
+    for srcs in by_checksum.values():
+        if len(srcs) > 1:
+            for src in srcs:
+                res[src] = (src, res[src][1])
+    return res
+
+
+def get_body(p):
     from bs4 import BeautifulSoup as bs
     text = p.read_text(encoding='utf8')
     body = bs(text, 'html5lib').find('body')
     body.name = 'div'
     body.attrs.clear()
     body.attrs['id'] = 'raw-content'
-    return f'{body}'.replace('.popover(', '.clickover(')
+    return body
+
+
+def fix_scripts(html):
+    return html.replace('.popover(', '.clickover(')
+
+
+def get_text(p):
+    return fix_scripts(f'{get_body(p)}')
+
+
+# Loads the fragments of a sectioned chapter when they scroll into view, or when a section is
+# navigated to. Without JavaScript - or if fetching fails, e.g. for pages opened from the file
+# system - the placeholders link to the fragments.
+FRAGMENT_LOADER = """
+(function () {
+    var sections = Array.prototype.slice.call(document.querySelectorAll('section.fragment'));
+    function load(section) {
+        var src = section.dataset.src;
+        if (!src) {
+            return Promise.resolve();
+        }
+        delete section.dataset.src;
+        return fetch(src)
+            .then(function (res) {
+                if (!res.ok) {
+                    throw new Error(res.statusText);
+                }
+                return res.text();
+            })
+            .then(function (text) { section.innerHTML = text; })
+            .catch(function () { section.dataset.src = src; });
+    }
+    function show() {
+        var id = decodeURIComponent(location.hash.slice(1));
+        if (!id || document.getElementById(id)) {
+            return;
+        }
+        var section = sections.find(function (s) { return s.dataset.ids.split(' ').indexOf(id) >= 0; });
+        (section ? load(section) : Promise.all(sections.map(load))).then(function () {
+            var e = document.getElementById(id);
+            if (e) {
+                e.scrollIntoView();
+            }
+        });
+    }
+    if ('IntersectionObserver' in window) {
+        var observer = new IntersectionObserver(function (entries) {
+            entries.forEach(function (entry) {
+                if (entry.isIntersecting) {
+                    observer.unobserve(entry.target);
+                    load(entry.target);
+                }
+            });
+        }, {rootMargin: '200px'});
+        sections.forEach(function (s) { observer.observe(s); });
+    }
+    window.addEventListener('hashchange', show);
+    show();
+})();
+"""
+
+
+def split_sections(root, outline: list[tuple[str, str]], prefix: str):
+    """
+    Split the chapter content - as returned by `get_body` - at the section headings listed in the
+    outline. The sections are replaced with placeholders, from which they are loaded on demand.
+
+    Elements containing headings - e.g. a `div` wrapping most of a chapter - are kept in the page
+    and split recursively. Headings missing in the content do not start a new fragment.
+
+    :return: Pair (content with placeholders, `dict` mapping fragment names to fragments).
+    """
+    soup = next(p for p in root.parents if p.parent is None)
+    titles = {id_: title for title, id_ in outline}
+    headings = [h for h in (root.find(id=id_) for id_ in titles) if h]
+    if not headings:
+        return f'{root}', {}
+    starts = {id(h) for h in headings}
+    wrappers = {id(p) for h in headings for p in h.parents}
+    fragments = {}
+
+    def split(element, section=None):
+        for child in list(element.children):
+            if id(child) in starts:
+                section = soup.new_tag('section', attrs={
+                    'class': 'fragment', 'data-src': f"{prefix}.{child['id']}.html"})
+                section.append(soup.new_tag('a', href=section['data-src'], string=titles[child['id']]))
+                child.insert_before(section)
+                fragments[section['data-src']] = (section, [])
+            elif id(child) in wrappers:
+                section = split(child, section)
+                continue
+            if section is not None:
+                fragments[section['data-src']][1].append(child.extract())
+        return section
+
+    split(root)
+    # List the IDs of outline sections in a fragment, to load it when a section is navigated to.
+    sections = {id(e): section for section, parts in fragments.values() for e in parts}
+    ids = collections.defaultdict(list)
+    for h in headings:
+        top = next(p for p in itertools.chain([h], h.parents) if p.parent is None)
+        ids[sections[id(top)]['data-src']].append(h['id'])
+    for section, _ in fragments.values():
+        section['data-ids'] = ' '.join(ids[section['data-src']])
+    return f'{root}', {name: ''.join(map(str, parts)) for name, (_, parts) in fragments.items()}
 
 
 def html_doc(head, body):
@@ -310,21 +624,98 @@ def html_doc(head, body):
     return "<!DOCTYPE html>\n{}".format(HTML.html(head, body, lang="en", dir="ltr"))
 
 
-def contribution_media(etc, directory, sid, title=None, author=None, extra_section=None):
+@dataclasses.dataclass
+class ReferenceStore:
+    """
+    The references of all chapters, collected into one bibliography, which chapters link to
+    instead of embedding their reference lists.
+
+    References are keyed by ID and checksum of the text, since the same ID is used for different
+    works - or different renderings of a work - in different chapters.
+    """
+    url: str = '../references.html'
+    refs: dict[str, str] = dataclasses.field(default_factory=dict)
+    # Sizes - in bytes - of the reference list items when embedding or linking the references.
+    embedded: int = 0
+    linked: int = 0
+    count: int = 0
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False)
+
+    def link(self, ref: dict) -> str:
+        """
+        Add a reference and return the list item linking to it.
+        """
+        text = ' '.join(ref['text'].split())
+        key = '{}-{}'.format(ref['id'], hashlib.md5(text.encode('utf8')).hexdigest()[:6])
+        res = HTML.li(
+            HTML.a((ref['key'] or '').strip() or ref['id'], href=f'{self.url}#{key}'),
+            id=ref['id'])
+        with self.lock:
+            self.refs[key] = text
+            self.embedded += len(str(HTML.li(ref['text'], id=ref['id'])).encode('utf8'))
+            self.linked += len(str(res).encode('utf8'))
+            self.count += 1
+        return res
+
+    def write(self, directory: pathlib.Path) -> str:
+        """
+        Write the bibliography as `references.html` to `directory`.
+
+        :return: Deduplication report, comparing the size of the embedded reference lists with \
+        the size of the lists of links plus the bibliography.
+        """
+        refs = sorted(self.refs.items(), key=lambda i: (i[1].lower(), i[0]))
+        directory.joinpath('references.html').write_text(html_doc(
+            [HTML.title('APiCS References')],
+            [HTML.h1('References'), HTML.ul(*[HTML.li(text, id=key) for key, text in refs])],
+        ), encoding='utf8')
+        stored = directory.joinpath('references.html').stat().st_size
+        return '{} chapter references, {} distinct: {} bytes embedded, {} bytes linked and ' \
+               'stored, {} bytes saved'.format(
+                   self.count, len(self.refs), self.embedded, self.linked + stored,
+                   self.embedded - self.linked - stored)
+
+
+def contribution_media(
+        etc,
+        directory,
+        sid,
+        title=None,
+        author=None,
+        extra_section=None,
+        thumbnails=None,
+        sectioned=False,
+        references: Optional[ReferenceStore] = None,
+):
+    """
+    Render a chapter as HTML page.
+
+    :param sectioned: Flag signaling whether to split the sections and the references of the \
+    chapter into fragments, which are loaded by the page on demand.
+    :param references: Store to add the references of the chapter to - which are then linked \
+    rather than embedded.
+    :return: Triple (HTML page, list of map paths, `dict` mapping fragment names to fragments).
+    """
     html_p = directory / f'{sid}.html'
-    html = get_text(html_p)
+    md = load(directory / '{}.json'.format(sid))
+    if title:
+        md['title'] = title
+
+    fragments = {}
+    if sectioned:
+        html, fragments = split_sections(get_body(html_p), md.get('outline') or [], sid)
+        html, fragments = fix_scripts(html), {k: fix_scripts(v) for k, v in fragments.items()}
+    else:
+        html = get_text(html_p)
     maps = []
     for fname in sorted(directory.glob('%s-*.png' % sid), key=lambda p: p.stem):
         if 'figure' in fname.stem:
             data_uri = data_url(fname, 'image/png')
             html = html.replace('{%s}' % fname.name, '%s' % data_uri)
+            fragments = {k: v.replace('{%s}' % fname.name, data_uri) for k, v in fragments.items()}
         else:
             maps.append(fname)
 
-    md = load(directory / '{}.json'.format(sid))
-    if title:
-        md['title'] = title
-
     #
     # FIXME: turn into CLDF markdown? or at least use CLDF markdown-like URL to link to other objects?
     #
@@ -346,7 +737,9 @@ def contribution_media(etc, directory, sid, title=None, author=None, extra_secti
             if cat:
                 after.append(HTML.h3(cat))
             after.append(HTML.ol(
-                *[HTML.li(ref['text'], id=ref['id']) for ref in refs],
+                *[
+                    references.link(ref) if references else HTML.li(ref['text'], id=ref['id'])
+                    for ref in refs],
                 **dict(class_='refs', start=str(count + 1))))
             count += len(refs)
 
@@ -362,19 +755,35 @@ def contribution_media(etc, directory, sid, title=None, author=None, extra_secti
             id='section-toc'))
 
     if maps:
-        before.append(HTML.div(
-            *[HTML.img(src='{}'.format(map.name)) for map in maps],
-            **dict(id='section-maps')))
+        if thumbnails is not None:  # Show thumbnails - if available - linking to the images.
+            imgs = [
+                HTML.a(
+                    HTML.img(src=thumbnails.get(map.name, map.name), loading='lazy'),
+                    href=map.name)
+                for map in maps]
+        else:
+            imgs = [HTML.img(src='{}'.format(map.name)) for map in maps]
+        before.append(HTML.div(*imgs, **dict(id='section-maps')))
     before.append(HTML.hr(style='clear: both;'))
 
     if extra_section:
         before.append(extra_section)
 
-    return html_doc(
-        [
-            HTML.title(md['title']),
-            HTML.style(etc.joinpath('project.css').read_text(encoding='utf8')),
-            HTML.style(directory.joinpath(f'{sid}.css').read_text(encoding='utf8')),
-        ],
-        before + [literal(str(html))] + after
-    ), maps
+    head = [
+        HTML.title(md['title']),
+        HTML.style(etc.joinpath('project.css').read_text(encoding='utf8')),
+        HTML.style(directory.joinpath(f'{sid}.css').read_text(encoding='utf8')),
+    ]
+    if sectioned:
+        if after:
+            name = f'{sid}.section-references.html'
+            fragments[name] = ''.join(str(e) for e in after)
+            after = [HTML.section(
+                HTML.a('References', href=name),
+                **{'class_': 'fragment', 'data-src': name, 'data-ids': 'section-references'})]
+        if fragments:
+            # Placeholders fill the viewport until loaded, so that only visible ones are loaded.
+            head.append(HTML.style('section.fragment[data-src] { min-height: 100vh; }'))
+            after.append(HTML.script(literal(FRAGMENT_LOADER)))
+
+    return html_doc(head, before + [literal(str(html))] + after), maps, fragments
@@ -0,0 +1,140 @@
+"""
+Content-addressed manifests of the CLDF directory, and delta bundles between releases.
+
+A manifest lists each file in the CLDF directory with size and md5 checksum. It is written to
+`cldf/manifest.json` by `cldfbench makecldf`, and must be refreshed if files are changed later,
+e.g. by `cldfbench cldfreadme`. A delta bundle is a ZIP archive containing the
+contents of new or changed files - stored by checksum, thus only once - and a description of
+the changes, which can be applied to a copy of the old CLDF directory:
+
+    python releaseutil.py manifest CLDF_DIR
+    python releaseutil.py delta OLD_MANIFEST CLDF_DIR BUNDLE
+    python releaseutil.py apply BUNDLE CLDF_DIR
+"""
+import json
+import shutil
+import pathlib
+import zipfile
+import argparse
+import tempfile
+from typing import Optional
+
+from csvw import dsv
+from clldutils.path import md5
+from clldutils.jsonlib import load, dump
+
+MANIFEST = 'manifest.json'
+DELTA = 'delta.json'
+ManifestType = dict[str, dict[str, object]]
+
+
+def manifest(directory: pathlib.Path, media: Optional[list[dict]] = None) -> ManifestType:
+    """
+    Compute the manifest for the files in `directory`.
+
+    Checksums of media files are taken from the MediaTable rows passed as `media`, since their
+    IDs are md5 checksums.
+    """
+    known = {row['Download_URL']: row for row in media or [] if not row.get('Path_In_Zip')}
+    res = {}
+    for p in sorted(directory.rglob('*')):
+        path = p.relative_to(directory).as_posix()
+        if p.is_file() and path != MANIFEST:
+            size = p.stat().st_size
+            if path in known and known[path]['size'] == size:
+                checksum = known[path]['ID']
+            else:
+                checksum = md5(p)
+            res[path] = {'size': size, 'md5': checksum}
+    return res
+
+
+def write_manifest(directory: pathlib.Path, media: Optional[list[dict]] = None) -> ManifestType:
+    res = manifest(directory, media)
+    dump(res, directory / MANIFEST, indent=1)
+    return res
+
+
+def read_media(directory: pathlib.Path) -> list[dict]:
+    """Read the MediaTable rows from `media.csv` - if it exists - to be passed into `manifest`."""
+    if not directory.joinpath('media.csv').exists():
+        return []
+    return [
+        dict(row, size=int(row['size']))
+        for row in dsv.reader(directory / 'media.csv', dicts=True)]
+
+
+def diff(old: ManifestType, new: ManifestType) -> tuple[ManifestType, list[str]]:
+    """
+    :return: Pair (new or changed files, removed paths).
+    """
+    return {p: v for p, v in new.items() if old.get(p) != v}, sorted(set(old) - set(new))
+
+
+def write_delta(old: ManifestType, directory: pathlib.Path, bundle: pathlib.Path) -> ManifestType:
+    """
+    Write a bundle with the changes between the files listed in manifest `old` and `directory`.
+    Contents which are available in the old files (e.g. moved files) are not included.
+    """
+    new = load(directory / MANIFEST)
+    changed, removed = diff(old, new)
+    old_checksums = {v['md5'] for v in old.values()}
+    with zipfile.ZipFile(bundle, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for path, v in sorted(changed.items()):
+            name = f"objects/{v['md5']}"
+            if v['md5'] not in old_checksums and name not in zf.NameToInfo:
+                zf.write(directory / path, name)
+        zf.writestr(DELTA, json.dumps(
+            {'changed': changed, 'removed': removed, 'manifest': new}, indent=1))
+    return changed
+
+
+def apply_delta(bundle: pathlib.Path, directory: pathlib.Path):
+    """
+    Update `directory` - which must contain the manifest of the old release - with a bundle.
+    """
+    old_paths = {v['md5']: p for p, v in load(directory / MANIFEST).items()}
+    with zipfile.ZipFile(bundle) as zf, tempfile.TemporaryDirectory() as tmp:
+        delta = json.loads(zf.read(DELTA))
+        # Stage the new contents first, since they may be copied from files which are removed.
+        for i, (path, v) in enumerate(sorted(delta['changed'].items())):
+            name = f"objects/{v['md5']}"
+            target = pathlib.Path(tmp) / str(i)
+            if name in zf.NameToInfo:
+                target.write_bytes(zf.read(name))
+            else:
+                shutil.copy(directory / old_paths[v['md5']], target)
+        for path in delta['removed']:
+            directory.joinpath(path).unlink()
+        for i, (path, v) in enumerate(sorted(delta['changed'].items())):
+            directory.joinpath(path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(pathlib.Path(tmp) / str(i), directory / path)
+        dump(delta['manifest'], directory / MANIFEST, indent=1)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('manifest', help='Write the manifest of a CLDF directory')
+    p.add_argument('cldf_dir', type=pathlib.Path)
+    p = sub.add_parser('delta', help='Write a delta bundle')
+    p.add_argument('old_manifest', type=pathlib.Path)
+    p.add_argument('cldf_dir', type=pathlib.Path)
+    p.add_argument('bundle', type=pathlib.Path)
+    p = sub.add_parser('apply', help='Apply a delta bundle')
+    p.add_argument('bundle', type=pathlib.Path)
+    p.add_argument('cldf_dir', type=pathlib.Path)
+    args = parser.parse_args(args)
+
+    if args.command == 'manifest':
+        res = write_manifest(args.cldf_dir, read_media(args.cldf_dir))
+        print(f'{len(res)} files')
+    elif args.command == 'delta':
+        changed = write_delta(load(args.old_manifest), args.cldf_dir, args.bundle)
+        print(f'{len(changed)} new or changed files, {args.bundle.stat().st_size} bytes')
+    else:
+        apply_delta(args.bundle, args.cldf_dir)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
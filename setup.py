@@ -19,5 +19,11 @@ setup(
         'test': [
             'pytest-cldf',
         ],
+        'export': [
+            'pyarrow',
+        ],
+        'images': [
+            'Pillow',
+        ],
     },
 )
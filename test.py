@@ -1,4 +1,123 @@
+import os
+import sys
+import csv
+import json
+import pathlib
+import subprocess
 
+import pytest
+
+
+def test_counts(cldf_dataset):
+    """Cheap check of the number of rows per table against etc/counts.json."""
+    counts = json.loads(
+        pathlib.Path(__file__).parent.joinpath('etc', 'counts.json').read_text(encoding='utf8'))
+    for table in cldf_dataset.tables:
+        if str(table.url) in counts:
+            with cldf_dataset.directory.joinpath(str(table.url)).open(encoding='utf8', newline='') as f:
+                assert sum(1 for _ in csv.DictReader(f)) == counts[str(table.url)], table.url
+
+
+def test_import_time():
+    """
+    The dataset module is imported via the cldfbench entry point for every command, so importing
+    it must not pull in the modules only needed to build the dataset.
+    """
+    pytest.importorskip('cldfbench')
+    deferred = ['mediautil', 'buildutil', 'exportutil', 'releaseutil', 'clldutils.html', 'bs4']
+    res = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'import sys, json, cldfbench, cldfbench_apics; '
+            'print(json.dumps([m for m in {} if m in sys.modules]))'.format(deferred)],
+        cwd=pathlib.Path(__file__).parent, capture_output=True, text=True, check=True)
+    assert json.loads(res.stdout) == []
+
+
+def test_delta_roundtrip(tmp_path):
+    from releaseutil import main, write_delta, apply_delta, MANIFEST
+
+    old, new = tmp_path / 'old', tmp_path / 'new'
+    for d, files in [
+        (old, {'a.csv': 'a', 'b.csv': 'b', 'Survey/1.html': 'x', 'README.md': 'old'}),
+        # b.csv is changed, Survey/1.html moved, README.md changed and Survey/2.html added.
+        (new, {'a.csv': 'a', 'b.csv': 'bb', 'Atlas/1.html': 'x', 'README.md': 'new',
+               'Survey/2.html': 'y'}),
+    ]:
+        for path, text in files.items():
+            d.joinpath(path).parent.mkdir(parents=True, exist_ok=True)
+            d.joinpath(path).write_text(text, encoding='utf8')
+        main(['manifest', str(d)])
+
+    old_manifest = json.loads(old.joinpath(MANIFEST).read_text(encoding='utf8'))
+    changed = write_delta(old_manifest, new, tmp_path / 'delta.zip')
+    assert set(changed) == {'b.csv', 'Atlas/1.html', 'README.md', 'Survey/2.html'}
+    apply_delta(tmp_path / 'delta.zip', old)
+    assert {p.relative_to(old) for p in old.rglob('*') if p.is_file()} == \
+        {p.relative_to(new) for p in new.rglob('*') if p.is_file()}
+    for p in new.rglob('*'):
+        if p.is_file():
+            assert old.joinpath(p.relative_to(new)).read_bytes() == p.read_bytes()
+
+
+def test_write_arrow_batches(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    from exportutil import _write_arrow
+
+    schema = pa.schema([
+        pa.field('ID', pa.string()),
+        pa.field('Language_ID', pa.dictionary(pa.int32(), pa.string()))])
+    rows = [{'ID': str(i), 'Language_ID': 'abcd'[min(i, 3)]} for i in range(5)]
+    _write_arrow(tmp_path / 'values.arrow', schema, rows, batch_size=2)
+    assert pa.ipc.open_file(tmp_path / 'values.arrow').read_all().to_pylist() == rows
+
+
+def test_spill():
+    from buildutil import SpillStore
+
+    store = SpillStore(3)
+    rows = [{'ID': str(i), 'Language_ID': 'abc'[i % 3], 'Value': i} for i in range(10)]
+    spilled, in_memory = store.list(), store.list()
+    spilled.extend(rows[:5])
+    for row in rows[5:]:
+        spilled.append(row)
+    assert spilled.spilled and len(spilled) == 10 and list(spilled) == rows
+
+    def key(r):
+        return r['Language_ID']
+
+    assert list(spilled.sorted(key)) == sorted(rows, key=key)  # The sort must be stable.
+    assert list(spilled) == rows
+    spilled.sort(key=lambda r: (r['Language_ID'], -r['Value']))
+    assert list(spilled) == sorted(rows, key=lambda r: (r['Language_ID'], -r['Value']))
+
+    in_memory.extend(rows[:2])
+    assert list(in_memory.sorted(key)) == sorted(rows[:2], key=key)
+
+    mapping = store.mapping((row['ID'], row) for row in rows)
+    assert len(mapping) == 10 and mapping['7'] == rows[7] and '10' not in mapping
+    assert list(mapping) == [row['ID'] for row in rows]
+
+
+def test_citation_names():
+    from mediautil import Contributors
+    from exportutil import Citation
+
+    contributors = Contributors(
+        {'Magnus Huber': 1}, {'1': 'Margot C. van den Berg', '2': 'Adrienne Bruyn'}, [], {}, {}, {})
+    citation = Citation.from_contribution(
+        {'ID': '1', 'type': 'StructureDataset', 'Name': 'Early Sranan structure dataset',
+         'Contributor_IDs': ['1', '2']},
+        contributors,
+        {})
+    assert 'author    = {van den Berg, Margot C. and Bruyn, Adrienne}' in citation.bibtex()
+    assert 'AU  - van den Berg, Margot C.' in citation.ris()
+    assert citation.csl()['author'][0] == {
+        'family': 'Berg', 'given': 'Margot C.', 'non-dropping-particle': 'van den'}
+
+
+@pytest.mark.skipif(not os.environ.get('APICS_RELEASE'), reason='Full validation only for releases')
 def test_valid(cldf_dataset, cldf_sqlite_database, cldf_logger):
     assert cldf_dataset.validate(log=cldf_logger)
     assert cldf_sqlite_database.query('select count(*) from MediaTable')[0][0] == 750